@@ -3,12 +3,18 @@ import os
 import sys
 import time
 import json
+import selectors
+import socket
+import sqlite3
 import threading
 import logging
 import logging.handlers
-import re
 import html
 import secrets
+import queue
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from typing import Dict, Tuple, List, Optional, Any
 
@@ -34,13 +40,21 @@ from telegram.ext import (
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "").strip()
 
 TERM_COLS = int(os.environ.get("TERM_COLS", "120"))
-TERM_LINES = int(os.environ.get("TERM_LINES", "200"))
+# 50x120 is already ~6000 chars, more than a Telegram message can show
+# (MAX_TG_CHARS); taller screens only add pyte bookkeeping we never render
+TERM_LINES = int(os.environ.get("TERM_LINES", "50"))
 UPDATE_INTERVAL = float(os.environ.get("UPDATE_INTERVAL", "1.0"))
 MAX_TG_CHARS = int(os.environ.get("MAX_TG_CHARS", "3900"))
 
 SESSION_TIMEOUT = int(os.environ.get("SESSION_TIMEOUT", "0"))  # seconds; 0=disabled
+WIZARD_TTL = int(os.environ.get("WIZARD_TTL", "600"))  # seconds until abandoned wizards are reaped
 KEEPALIVE_SEC = int(os.environ.get("KEEPALIVE_SEC", "30"))
 PRIVATE_ONLY = os.environ.get("PRIVATE_ONLY", "0").strip().lower() in ("1", "true", "yes", "on")
+
+# Webhook delivery (push) instead of long-polling when WEBHOOK_URL is set.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").strip().rstrip("/")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "").strip() or secrets.token_hex(16)
 STRICT_HOST_KEY = os.environ.get("STRICT_HOST_KEY", "0").strip().lower() in ("1", "true", "yes", "on")
 
 def _parse_csv_ints(val: str) -> List[int]:
@@ -55,8 +69,9 @@ def _parse_csv_ints(val: str) -> List[int]:
             pass
     return out
 
-ALLOWED_USERS = set(_parse_csv_ints(os.environ.get("ALLOWED_USERS", "")))
-ALLOWED_CHATS = set(_parse_csv_ints(os.environ.get("ALLOWED_CHATS", "")))
+ALLOWED_USERS = frozenset(_parse_csv_ints(os.environ.get("ALLOWED_USERS", "")))
+ALLOWED_CHATS = frozenset(_parse_csv_ints(os.environ.get("ALLOWED_CHATS", "")))
+_ACL_OPEN = not (ALLOWED_USERS or ALLOWED_CHATS)
 
 INSTALL_DIR = os.environ.get("INSTALL_DIR", "/opt/sshbot")
 DATA_DIR = os.environ.get("DATA_DIR", f"{INSTALL_DIR}/data")
@@ -85,8 +100,6 @@ logger.addHandler(sh)
 # ================= TYPES / STATE =================
 SessionKey = Tuple[int, int]  # (chat_id, user_id)
 
-SSH_RE = re.compile(r"([^@]+)@([^:]+)(?::(\d+))?$")
-
 KEYS = {
     "TAB": "\t",
     "ENTER": "\r",
@@ -138,7 +151,14 @@ class WizardState:
     prompt_msg_id: int = 0
     created_at: float = field(default_factory=time.time)
 
-STATE_LOCK = threading.Lock()
+# Session state is guarded by striped locks keyed on user_id, so one
+# user's activity never serializes behind another's.
+_STRIPE_COUNT = 64
+_STRIPES = [threading.Lock() for _ in range(_STRIPE_COUNT)]
+
+def state_lock(key: SessionKey) -> threading.Lock:
+    return _STRIPES[hash(key[1]) & (_STRIPE_COUNT - 1)]
+
 DATA_LOCK = threading.Lock()
 
 SESSIONS: Dict[SessionKey, "SSHSession"] = {}
@@ -149,32 +169,40 @@ WIZARD: Dict[SessionKey, WizardState] = {}
 def now_ts() -> float:
     return time.time()
 
+# Telegram HTML only needs &, < and > escaped; a translate table skips the
+# three chained str.replace passes html.escape does per call.
+_HTML_ESC = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
 def html_pre(text: str) -> str:
-    return f"<pre>{html.escape(text)}</pre>"
+    return f"<pre>{text.translate(_HTML_ESC)}</pre>"
 
 def clamp_tg(text: str) -> str:
+    """Keep the newest whole lines that fit in MAX_TG_CHARS."""
+    if len(text) <= MAX_TG_CHARS:
+        return text
     lines = text.splitlines()
-    out: List[str] = []
-    for line in reversed(lines):
-        out.insert(0, line)
-        if len("\n".join(out)) > MAX_TG_CHARS:
-            out.pop(0)
+    total = 0
+    i = len(lines)
+    while i > 0:
+        i -= 1
+        total += len(lines[i]) + 1
+        if total > MAX_TG_CHARS:
+            i += 1
             break
-    return "\n".join(out)
+    return "\n".join(lines[i:])
 
 def is_private_chat(update: Update) -> bool:
-    try:
-        return update.effective_chat and update.effective_chat.type == "private"
-    except Exception:
-        return False
+    chat = update.effective_chat
+    return chat is not None and chat.type == "private"
 
 def is_authorized(update: Update) -> bool:
-    chat_id = update.effective_chat.id if update.effective_chat else 0
-    user_id = update.effective_user.id if update.effective_user else 0
-
+    # runs on every update; the open-ACL common case is two boolean tests
     if PRIVATE_ONLY and not is_private_chat(update):
         return False
-
+    if _ACL_OPEN:
+        return True
+    chat_id = update.effective_chat.id if update.effective_chat else 0
+    user_id = update.effective_user.id if update.effective_user else 0
     if ALLOWED_USERS and user_id not in ALLOWED_USERS:
         return False
     if ALLOWED_CHATS and chat_id not in ALLOWED_CHATS:
@@ -198,12 +226,21 @@ def session_key_from_query(update: Update) -> SessionKey:
     return (q.message.chat_id, q.from_user.id)
 
 def parse_target(text: str) -> Optional[Tuple[str, str, int]]:
+    """Parse user@host[:port]; plain string ops, no regex engine."""
     text = (text or "").strip()
-    m = SSH_RE.match(text)
-    if not m:
+    if not text or len(text.split()) != 1:
+        return None
+    user, sep, rest = text.partition("@")
+    if not sep or not user or "@" in rest:
+        return None
+    host, sep, port_s = rest.partition(":")
+    if not host or ":" in port_s:
+        return None
+    if not sep:
+        return user, host, 22
+    if not port_s.isdigit() or len(port_s) > 5:
         return None
-    user, host, port = m.group(1), m.group(2), int(m.group(3) or 22)
-    return user, host, port
+    return user, host, int(port_s)
 
 def gen_server_id() -> str:
     # short stable id for callback_data (<=64 bytes)
@@ -219,153 +256,300 @@ def validate_server_name(name: str) -> Optional[str]:
         return "اسم سرور کاراکتر نامعتبر دارد."
     return None
 
-# ================= SERVER DB (ID-BASED + MIGRATION) =================
-def load_server_db() -> Dict[str, Any]:
-    with DATA_LOCK:
-        try:
-            if not os.path.exists(SERVER_DB):
-                return {"users": {}}
-            with open(SERVER_DB, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            if not isinstance(data, dict):
-                return {"users": {}}
-            if "users" not in data or not isinstance(data["users"], dict):
-                data["users"] = {}
-            return data
-        except Exception:
-            logger.exception("Failed to load server db")
-            return {"users": {}}
-
-def save_server_db(db: Dict[str, Any]) -> None:
-    with DATA_LOCK:
-        try:
-            tmp = SERVER_DB + ".tmp"
-            os.makedirs(os.path.dirname(SERVER_DB), exist_ok=True)
-            with open(tmp, "w", encoding="utf-8") as f:
-                json.dump(db, f, ensure_ascii=False, indent=2)
-            os.replace(tmp, SERVER_DB)
-        except Exception:
-            logger.exception("Failed to save server db")
+# ================= SERVER DB (SQLITE + JSON MIGRATION) =================
+SQLITE_DB = os.environ.get("SQLITE_DB", f"{DATA_DIR}/servers.db")
+
+_DB_CONN: Optional[sqlite3.Connection] = None
+
+def _db() -> sqlite3.Connection:
+    """Shared sqlite connection (WAL); every use is serialized by DATA_LOCK."""
+    global _DB_CONN
+    if _DB_CONN is None:
+        os.makedirs(os.path.dirname(SQLITE_DB), exist_ok=True)
+        conn = sqlite3.connect(SQLITE_DB, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " user_id INTEGER PRIMARY KEY,"
+            " default_id TEXT NOT NULL DEFAULT '')"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS servers ("
+            " user_id INTEGER NOT NULL,"
+            " id TEXT NOT NULL,"
+            " name TEXT NOT NULL,"
+            " user TEXT NOT NULL,"
+            " host TEXT NOT NULL,"
+            " port INTEGER NOT NULL DEFAULT 22,"
+            " created_at INTEGER NOT NULL DEFAULT 0,"
+            " last_used INTEGER NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (user_id, id))"
+        )
+        conn.commit()
+        _DB_CONN = conn
+        _migrate_json_db(conn)
+    return _DB_CONN
 
-def _ensure_user_record(db: Dict[str, Any], user_id: int) -> Dict[str, Any]:
-    users = db.setdefault("users", {})
-    rec = users.get(str(user_id))
-    if not isinstance(rec, dict):
-        rec = {}
-    if "servers" not in rec or not isinstance(rec["servers"], dict):
-        rec["servers"] = {}
-    if "default" not in rec or not isinstance(rec["default"], str):
-        rec["default"] = ""
-    users[str(user_id)] = rec
-    return rec
-
-def _migrate_if_needed(db: Dict[str, Any], user_id: int) -> None:
+def _migrate_json_db(conn: sqlite3.Connection) -> None:
     """
-    Old format (name-based):
-      servers = { "myserver": {"user":..., "host":..., "port":...}, ... }
-      default = "myserver"
-    New format (id-based):
-      servers = { "a1b2c3d4": {"name":"myserver", "user":..., "host":..., "port":...}, ... }
-      default = "a1b2c3d4"
+    One-time import of the legacy servers.json. Handles both layouts:
+      name-based:  servers = { "myserver": {"user":..., "host":..., "port":...} }
+      id-based:    servers = { "a1b2c3d4": {"name":"myserver", "user":..., ...} }
+    The JSON file is renamed to *.migrated afterwards so this runs once.
     """
-    rec = _ensure_user_record(db, user_id)
-    servers = rec.get("servers", {})
-    default = rec.get("default", "")
-
-    if not servers:
+    if not os.path.exists(SERVER_DB):
         return
-
-    # detect old format: values missing "name"
-    old_format = False
-    for k, v in servers.items():
-        if isinstance(v, dict) and "name" not in v:
-            # likely old
-            old_format = True
-            break
-
-    if not old_format:
+    try:
+        with open(SERVER_DB, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception:
+        logger.exception("Failed to read legacy server db")
         return
 
-    new_servers: Dict[str, Any] = {}
-    name_to_id: Dict[str, str] = {}
-
-    for name, info in list(servers.items()):
-        if not isinstance(info, dict):
+    users = data.get("users", {}) if isinstance(data, dict) else {}
+    for uid_s, rec in users.items():
+        try:
+            uid = int(uid_s)
+        except Exception:
+            continue
+        if not isinstance(rec, dict):
+            continue
+        servers = rec.get("servers", {})
+        default = rec.get("default", "")
+        if not isinstance(servers, dict):
             continue
-        sid = gen_server_id()
-        while sid in new_servers:
-            sid = gen_server_id()
-        info2 = dict(info)
-        info2["name"] = name
-        new_servers[sid] = info2
-        name_to_id[name] = sid
 
-    # migrate default
-    new_default = name_to_id.get(default, "")
-    rec["servers"] = new_servers
-    rec["default"] = new_default
+        default_id = ""
+        for key, info in servers.items():
+            if not isinstance(info, dict):
+                continue
+            if "name" in info:
+                sid, name = key, str(info.get("name", key))
+            else:
+                sid, name = gen_server_id(), key
+            if key == default:
+                default_id = sid
+            conn.execute(
+                "INSERT OR REPLACE INTO servers"
+                " (user_id, id, name, user, host, port, created_at, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    uid, sid, name,
+                    str(info.get("user", "")),
+                    str(info.get("host", "")),
+                    int(info.get("port", 22)),
+                    int(info.get("created_at", now_ts())),
+                    int(info.get("last_used", now_ts())),
+                ),
+            )
+        conn.execute(
+            "INSERT OR REPLACE INTO users (user_id, default_id) VALUES (?, ?)",
+            (uid, default_id),
+        )
+    conn.commit()
+
+    try:
+        os.replace(SERVER_DB, SERVER_DB + ".migrated")
+        logger.info("Migrated legacy %s into %s", SERVER_DB, SQLITE_DB)
+    except Exception:
+        logger.exception("Could not rename migrated server db")
+
+# Per-user read cache in front of sqlite; writers invalidate. Menu renders
+# hit the DB once per user instead of on every button press.
+_USER_CACHE_LOCK = threading.Lock()
+_SERVERS_CACHE: Dict[int, Dict[str, Any]] = {}
+_DEFAULT_CACHE: Dict[int, str] = {}
+# bumped on every write; doubles as the fingerprint for derived caches
+# like the rendered servers keyboard
+_SERVERS_VER: Dict[int, int] = {}
+
+def _invalidate_user_cache(user_id: int) -> None:
+    with _USER_CACHE_LOCK:
+        _SERVERS_CACHE.pop(user_id, None)
+        _DEFAULT_CACHE.pop(user_id, None)
+        _SERVERS_VER[user_id] = _SERVERS_VER.get(user_id, 0) + 1
+
+def get_servers_version(user_id: int) -> int:
+    with _USER_CACHE_LOCK:
+        return _SERVERS_VER.get(user_id, 0)
 
 def get_user_servers(user_id: int) -> Dict[str, Any]:
-    db = load_server_db()
-    _migrate_if_needed(db, user_id)
-    rec = _ensure_user_record(db, user_id)
-    # save if migrated
-    save_server_db(db)
-    servers = rec.get("servers", {})
-    return servers if isinstance(servers, dict) else {}
+    with _USER_CACHE_LOCK:
+        cached = _SERVERS_CACHE.get(user_id)
+    if cached is None:
+        with DATA_LOCK:
+            rows = _db().execute(
+                "SELECT id, name, user, host, port, created_at, last_used"
+                " FROM servers WHERE user_id = ?",
+                (user_id,),
+            ).fetchall()
+        cached = {
+            r[0]: {"name": r[1], "user": r[2], "host": r[3], "port": r[4],
+                   "created_at": r[5], "last_used": r[6]}
+            for r in rows
+        }
+        with _USER_CACHE_LOCK:
+            _SERVERS_CACHE[user_id] = cached
+    # callers mutate the result before writing it back, so hand out a copy
+    return {sid: dict(info) for sid, info in cached.items()}
 
 def set_user_servers(user_id: int, servers: Dict[str, Any], default_id: Optional[str] = None) -> None:
-    db = load_server_db()
-    rec = _ensure_user_record(db, user_id)
-    rec["servers"] = servers
-    if default_id is not None:
-        rec["default"] = default_id
-    save_server_db(db)
+    with DATA_LOCK:
+        try:
+            conn = _db()
+            conn.execute("DELETE FROM servers WHERE user_id = ?", (user_id,))
+            for sid, info in servers.items():
+                if not isinstance(info, dict):
+                    continue
+                conn.execute(
+                    "INSERT OR REPLACE INTO servers"
+                    " (user_id, id, name, user, host, port, created_at, last_used)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        user_id, sid,
+                        str(info.get("name", sid)),
+                        str(info.get("user", "")),
+                        str(info.get("host", "")),
+                        int(info.get("port", 22)),
+                        int(info.get("created_at", now_ts())),
+                        int(info.get("last_used", now_ts())),
+                    ),
+                )
+            if default_id is not None:
+                conn.execute(
+                    "INSERT INTO users (user_id, default_id) VALUES (?, ?)"
+                    " ON CONFLICT(user_id) DO UPDATE SET default_id = excluded.default_id",
+                    (user_id, default_id),
+                )
+            conn.commit()
+        except Exception:
+            logger.exception("Failed to save server db")
+            _invalidate_user_cache(user_id)
+            return
+    # write through: the next read serves from memory instead of reloading
+    with _USER_CACHE_LOCK:
+        _SERVERS_CACHE[user_id] = {
+            sid: dict(info) for sid, info in servers.items() if isinstance(info, dict)
+        }
+        if default_id is not None:
+            _DEFAULT_CACHE[user_id] = default_id
+        _SERVERS_VER[user_id] = _SERVERS_VER.get(user_id, 0) + 1
+
+def touch_server_last_used(user_id: int, server_id: str) -> None:
+    """Bump last_used without rewriting the user's whole server set."""
+    ts = int(now_ts())
+    with DATA_LOCK:
+        try:
+            conn = _db()
+            conn.execute(
+                "UPDATE servers SET last_used = ? WHERE user_id = ? AND id = ?",
+                (ts, user_id, server_id),
+            )
+            conn.commit()
+        except Exception:
+            logger.exception("Failed to save server db")
+            _invalidate_user_cache(user_id)
+            return
+    # last_used is not rendered in the keyboard, so patch the cache in
+    # place without bumping the version
+    with _USER_CACHE_LOCK:
+        cached = _SERVERS_CACHE.get(user_id)
+        if cached is not None and server_id in cached:
+            cached[server_id]["last_used"] = ts
 
 def get_user_default_server_id(user_id: int) -> str:
-    db = load_server_db()
-    _migrate_if_needed(db, user_id)
-    rec = _ensure_user_record(db, user_id)
-    save_server_db(db)
-    d = rec.get("default", "")
-    return d if isinstance(d, str) else ""
+    with _USER_CACHE_LOCK:
+        cached = _DEFAULT_CACHE.get(user_id)
+    if cached is None:
+        with DATA_LOCK:
+            row = _db().execute(
+                "SELECT default_id FROM users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        cached = row[0] if row else ""
+        with _USER_CACHE_LOCK:
+            _DEFAULT_CACHE[user_id] = cached
+    return cached
 
 def set_user_default_server_id(user_id: int, server_id: str) -> None:
-    db = load_server_db()
-    _migrate_if_needed(db, user_id)
-    rec = _ensure_user_record(db, user_id)
-    rec["default"] = server_id
-    save_server_db(db)
+    with DATA_LOCK:
+        try:
+            conn = _db()
+            conn.execute(
+                "INSERT INTO users (user_id, default_id) VALUES (?, ?)"
+                " ON CONFLICT(user_id) DO UPDATE SET default_id = excluded.default_id",
+                (user_id, server_id),
+            )
+            conn.commit()
+        except Exception:
+            logger.exception("Failed to save server db")
+            _invalidate_user_cache(user_id)
+            return
+    with _USER_CACHE_LOCK:
+        _DEFAULT_CACHE[user_id] = server_id
+        _SERVERS_VER[user_id] = _SERVERS_VER.get(user_id, 0) + 1
+
+# lowercased name -> sid per user, rebuilt lazily when the version moves
+_NAME_INDEX: Dict[int, Tuple[int, Dict[str, str]]] = {}
 
 def find_server_by_name(user_id: int, name: str) -> Optional[Tuple[str, Dict[str, Any]]]:
     name = (name or "").strip()
     servers = get_user_servers(user_id)
-    # exact match
+    # exact match wins over a case-insensitive one when both exist
     for sid, info in servers.items():
         if isinstance(info, dict) and info.get("name") == name:
             return sid, info
-    # case-insensitive fallback for ascii names
-    low = name.lower()
-    for sid, info in servers.items():
-        if isinstance(info, dict) and str(info.get("name", "")).lower() == low:
-            return sid, info
+    ver = get_servers_version(user_id)
+    ent = _NAME_INDEX.get(user_id)
+    if ent is None or ent[0] != ver:
+        index = {
+            str(info.get("name", "")).lower(): sid
+            for sid, info in servers.items() if isinstance(info, dict)
+        }
+        _NAME_INDEX[user_id] = (ver, index)
+    else:
+        index = ent[1]
+    sid = index.get(name.lower())
+    if sid is not None and sid in servers:
+        return sid, servers[sid]
     return None
 
 # ================= UI (INLINE BUTTONS) =================
+# Static keyboards are built once at import; rebuilding them per update
+# just allocates the same object tree over and over.
+_KB_MAIN = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("🔌 اتصال", callback_data="M:CONNECT"),
+         InlineKeyboardButton("📚 سرورها", callback_data="M:SERVERS")],
+        [InlineKeyboardButton("📊 وضعیت", callback_data="M:STATUS"),
+         InlineKeyboardButton("🛑 قطع", callback_data="M:STOP")],
+        [InlineKeyboardButton("➕ افزودن سرور", callback_data="M:ADD_SERVER"),
+         InlineKeyboardButton("🆔 آی‌دی من", callback_data="M:MYID")],
+        [InlineKeyboardButton("❓ راهنما", callback_data="M:HELP")],
+    ]
+)
+
+_KB_WIZARD_CANCEL = InlineKeyboardMarkup([[InlineKeyboardButton("❌ لغو", callback_data="W:CANCEL")]])
+
 def keyboard_main(user_id: int) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        [
-            [InlineKeyboardButton("🔌 اتصال", callback_data="M:CONNECT"),
-             InlineKeyboardButton("📚 سرورها", callback_data="M:SERVERS")],
-            [InlineKeyboardButton("📊 وضعیت", callback_data="M:STATUS"),
-             InlineKeyboardButton("🛑 قطع", callback_data="M:STOP")],
-            [InlineKeyboardButton("➕ افزودن سرور", callback_data="M:ADD_SERVER"),
-             InlineKeyboardButton("🆔 آی‌دی من", callback_data="M:MYID")],
-            [InlineKeyboardButton("❓ راهنما", callback_data="M:HELP")],
-        ]
-    )
+    return _KB_MAIN
+
+# bounded so a long-running instance with many one-off users cannot
+# grow this without limit; eviction is least-recently-used
+_KB_LIST_CACHE_MAX = 512
+_KB_LIST_CACHE_LOCK = threading.Lock()
+_KB_LIST_CACHE: "OrderedDict[int, Tuple[int, InlineKeyboardMarkup]]" = OrderedDict()
 
 def keyboard_servers_list(user_id: int) -> InlineKeyboardMarkup:
+    # the list only changes when the user's servers change; reuse the
+    # built markup until a write bumps the version
+    ver = get_servers_version(user_id)
+    with _KB_LIST_CACHE_LOCK:
+        cached = _KB_LIST_CACHE.get(user_id)
+        if cached is not None and cached[0] == ver:
+            _KB_LIST_CACHE.move_to_end(user_id)
+            return cached[1]
+
     servers = get_user_servers(user_id)
     default_id = get_user_default_server_id(user_id)
 
@@ -377,8 +561,17 @@ def keyboard_servers_list(user_id: int) -> InlineKeyboardMarkup:
 
     rows.append([InlineKeyboardButton("➕ اضافه", callback_data="M:ADD_SERVER"),
                  InlineKeyboardButton("⬅️ منو", callback_data="M:MENU")])
-    return InlineKeyboardMarkup(rows)
-
+    kb = InlineKeyboardMarkup(rows)
+    with _KB_LIST_CACHE_LOCK:
+        _KB_LIST_CACHE[user_id] = (ver, kb)
+        _KB_LIST_CACHE.move_to_end(user_id)
+        while len(_KB_LIST_CACHE) > _KB_LIST_CACHE_MAX:
+            _KB_LIST_CACHE.popitem(last=False)
+    return kb
+
+# the markup only depends on the server id, so cache the built objects;
+# ids are short-lived enough that 256 entries covers every active user
+@functools.lru_cache(maxsize=256)
 def keyboard_server_actions(server_id: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
@@ -390,9 +583,441 @@ def keyboard_server_actions(server_id: str) -> InlineKeyboardMarkup:
     )
 
 def keyboard_wizard_cancel() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("❌ لغو", callback_data="W:CANCEL")]])
+    return _KB_WIZARD_CANCEL
+
+_KB_SESSION_PAGE0 = InlineKeyboardMarkup(
+    [
+        [
+            InlineKeyboardButton("TAB", callback_data="K:TAB"),
+            InlineKeyboardButton("ENTER", callback_data="K:ENTER"),
+            InlineKeyboardButton("ESC", callback_data="K:ESC"),
+            InlineKeyboardButton("BS", callback_data="K:BS"),
+        ],
+        [
+            InlineKeyboardButton("↑", callback_data="K:UP"),
+            InlineKeyboardButton("↓", callback_data="K:DOWN"),
+            InlineKeyboardButton("←", callback_data="K:LEFT"),
+            InlineKeyboardButton("→", callback_data="K:RIGHT"),
+        ],
+        [
+            InlineKeyboardButton("PGUP", callback_data="K:PGUP"),
+            InlineKeyboardButton("PGDN", callback_data="K:PGDN"),
+            InlineKeyboardButton("Ctrl+C", callback_data="MC:CTRL_C"),
+            InlineKeyboardButton("Ctrl+Z", callback_data="MC:CTRL_Z"),
+        ],
+        [
+            InlineKeyboardButton("Nano Exit (Ctrl+X)", callback_data="K:NANO_EXIT"),
+        ],
+        [
+            InlineKeyboardButton("⚡ سریع", callback_data="KB:PAGE:1"),
+            InlineKeyboardButton("📚 سرورها", callback_data="A:SERVERS"),
+            InlineKeyboardButton("🛑 قطع", callback_data="A:STOP"),
+        ],
+    ]
+)
+
+_KB_SESSION_PAGE1 = InlineKeyboardMarkup(
+    [
+        [
+            InlineKeyboardButton("uptime", callback_data="QC:UPTIME"),
+            InlineKeyboardButton("df -h", callback_data="QC:DF"),
+            InlineKeyboardButton("free -h", callback_data="QC:FREE"),
+        ],
+        [
+            InlineKeyboardButton("whoami", callback_data="QC:WHOAMI"),
+            InlineKeyboardButton("pwd", callback_data="QC:PWD"),
+            InlineKeyboardButton("ls", callback_data="QC:LS"),
+        ],
+        [
+            InlineKeyboardButton("clear", callback_data="QC:CLEAR"),
+            InlineKeyboardButton("Ctrl+L", callback_data="MC:CTRL_L"),
+            InlineKeyboardButton("Ctrl+D", callback_data="MC:CTRL_D"),
+        ],
+        [
+            InlineKeyboardButton("🔙 بازگشت", callback_data="KB:PAGE:0"),
+            InlineKeyboardButton("📚 سرورها", callback_data="A:SERVERS"),
+            InlineKeyboardButton("🛑 قطع", callback_data="A:STOP"),
+        ],
+    ]
+)
+
+# ================= OUTBOUND IO =================
+# Telegram HTTP calls are handed off to a bounded pool so dispatcher
+# threads never block on the network; a per-chat queue keeps ordering.
+IO_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="tg-io")
+
+_ORDERED_LOCK = threading.Lock()
+_ORDERED_QUEUES: Dict[int, "queue.Queue"] = {}
+_ORDERED_BUSY: set = set()
+
+def submit_ordered(chat_id: int, fn, *args, **kwargs) -> None:
+    with _ORDERED_LOCK:
+        q_ = _ORDERED_QUEUES.setdefault(chat_id, queue.Queue())
+        q_.put((fn, args, kwargs))
+        if chat_id in _ORDERED_BUSY:
+            return
+        _ORDERED_BUSY.add(chat_id)
+    IO_POOL.submit(_drain_ordered, chat_id)
+
+def _drain_ordered(chat_id: int) -> None:
+    q_ = _ORDERED_QUEUES[chat_id]
+    while True:
+        try:
+            fn, args, kwargs = q_.get_nowait()
+        except queue.Empty:
+            with _ORDERED_LOCK:
+                if q_.empty():
+                    _ORDERED_BUSY.discard(chat_id)
+                    return
+            continue
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            # flood control: honor the advertised wait once, then retry the
+            # same call so ordering within the chat is preserved
+            retry_after = getattr(e, "retry_after", None)
+            if retry_after:
+                time.sleep(float(retry_after))
+                try:
+                    fn(*args, **kwargs)
+                except Exception as e2:
+                    logger.debug("Outbound call failed after retry: %s", e2)
+            else:
+                logger.debug("Outbound call failed: %s", e)
+
+def _edit_or_send(bot, q, chat_id: int, text: str, reply_markup) -> None:
+    try:
+        q.edit_message_text(text, reply_markup=reply_markup)
+    except Exception:
+        bot.send_message(chat_id, text, reply_markup=reply_markup)
+
+# ================= DELETE QUEUE =================
+_DELETE_BATCH_MAX = 50
+_DELETE_DEBOUNCE = 2.0
+
+_DELETE_LOCK = threading.Lock()
+_DELETE_BUF: Dict[int, List[int]] = {}
+_DELETE_TIMERS: Dict[int, threading.Timer] = {}
+
+def queue_delete(bot, chat_id: int, message_id: int, flush: bool = False) -> None:
+    """Collect per-chat deletions and flush them through one deleteMessages call.
+
+    flush=True skips the debounce for messages that must disappear right
+    away (plaintext passwords), flushing the chat's whole buffer off-thread.
+    """
+    with _DELETE_LOCK:
+        buf = _DELETE_BUF.setdefault(chat_id, [])
+        buf.append(message_id)
+        flush_now = flush or len(buf) >= _DELETE_BATCH_MAX
+        if not flush_now and chat_id not in _DELETE_TIMERS:
+            t = threading.Timer(_DELETE_DEBOUNCE, _flush_deletes, args=(bot, chat_id))
+            t.daemon = True
+            _DELETE_TIMERS[chat_id] = t
+            t.start()
+    if flush_now:
+        if flush:
+            IO_POOL.submit(_flush_deletes, bot, chat_id)
+        else:
+            _flush_deletes(bot, chat_id)
+
+def _flush_deletes(bot, chat_id: int) -> None:
+    with _DELETE_LOCK:
+        ids = _DELETE_BUF.pop(chat_id, [])
+        timer = _DELETE_TIMERS.pop(chat_id, None)
+    if timer:
+        timer.cancel()
+    if not ids:
+        return
+    for i in range(0, len(ids), 100):
+        batch = ids[i:i + 100]
+        try:
+            # Bot API 7.0; PTB v13 has no typed wrapper, so go through _post
+            bot._post("deleteMessages", {"chat_id": chat_id, "message_ids": batch})
+        except Exception:
+            # older servers / single bad id: fall back to one-by-one
+            for mid in batch:
+                try:
+                    bot.delete_message(chat_id=chat_id, message_id=mid)
+                except Exception:
+                    pass
+
+# ================= EDIT QUEUE =================
+EDIT_RATE_LIMIT = float(os.environ.get("EDIT_RATE_LIMIT", "25"))  # edits/sec, global
+
+class EditQueue:
+    """Coalesces edit_message_text calls behind a global token bucket.
+
+    Only the latest pending state per (chat_id, message_id) is kept, so
+    bursty terminal output collapses to one edit instead of tripping
+    Telegram's ~30 msg/s ceiling with states the user never sees.
+    """
+
+    def __init__(self, rate: float = EDIT_RATE_LIMIT):
+        self._interval = 1.0 / max(1.0, rate)
+        self._cond = threading.Condition()
+        self._pending: Dict[Tuple[int, int], Tuple[Any, str, Any]] = {}
+        self._discarded: set = set()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, bot, chat_id: int, message_id: int, text: str, reply_markup) -> None:
+        with self._cond:
+            self._discarded.discard((chat_id, message_id))
+            self._pending[(chat_id, message_id)] = (bot, text, reply_markup)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def discard(self, chat_id: int, message_id: int) -> None:
+        """Drop any pending edit for a message that is about to be finalized."""
+        with self._cond:
+            key = (chat_id, message_id)
+            self._pending.pop(key, None)
+            # remember the key so an in-flight RetryAfter cannot resurrect it
+            if len(self._discarded) > 1024:
+                self._discarded.clear()
+            self._discarded.add(key)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                key, payload = next(iter(self._pending.items()))
+                del self._pending[key]
+            chat_id, message_id = key
+            bot, text, reply_markup = payload
+            try:
+                bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    text=text,
+                    parse_mode=ParseMode.HTML,
+                    reply_markup=reply_markup,
+                    disable_web_page_preview=True,
+                )
+            except Exception as e:
+                retry_after = getattr(e, "retry_after", None)
+                if retry_after:
+                    time.sleep(float(retry_after))
+                    with self._cond:
+                        # keep a newer state if one arrived meanwhile, and
+                        # stay dead if the message was discarded while we slept
+                        if key not in self._discarded:
+                            self._pending.setdefault(key, payload)
+                else:
+                    logger.debug("Edit failed: %s", e)
+            time.sleep(self._interval)
+
+EDIT_QUEUE = EditQueue()
+
+# ================= DNS CACHE =================
+DNS_TTL = 300  # seconds; saved servers rarely move between connects
+
+_DNS_LOCK = threading.Lock()
+_DNS_CACHE: Dict[Tuple[str, int], Tuple[float, list]] = {}
+
+def resolve_host(host: str, port: int) -> list:
+    """getaddrinfo with a small TTL cache; lookups block and we connect often."""
+    cache_key = (host, port)
+    now = now_ts()
+    with _DNS_LOCK:
+        ent = _DNS_CACHE.get(cache_key)
+        if ent and now - ent[0] < DNS_TTL:
+            return ent[1]
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    with _DNS_LOCK:
+        _DNS_CACHE[cache_key] = (now, infos)
+    return infos
+
+def warm_dns(host: str, port: int) -> None:
+    """Pre-resolve in the background so the next connect skips the lookup."""
+    def _warm():
+        try:
+            resolve_host(host, port)
+        except OSError:
+            pass
+    IO_POOL.submit(_warm)
+
+def open_tcp(host: str, port: int, timeout: float = 15.0) -> socket.socket:
+    """Open a TCP socket to host:port using the cached resolution."""
+    last_err: Optional[OSError] = None
+    for af, socktype, proto, _canon, sa in resolve_host(host, port):
+        sock = socket.socket(af, socktype, proto)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(sa)
+            return sock
+        except OSError as e:
+            last_err = e
+            sock.close()
+    raise last_err or OSError(f"could not connect to {host}:{port}")
+
+# ================= TRANSPORT POOL =================
+PoolKey = Tuple[str, str, int, int]  # (ssh user, host, port, telegram user_id)
+
+MAX_CHANNELS_PER_TRANSPORT = int(os.environ.get("MAX_CHANNELS_PER_TRANSPORT", "8"))
+POOL_IDLE_TTL = max(60, KEEPALIVE_SEC * 3)
+
+@dataclass
+class PooledTransport:
+    client: paramiko.SSHClient
+    refs: int = 0
+    last_used: float = field(default_factory=time.time)
+
+POOL_LOCK = threading.Lock()
+TRANSPORT_POOL: Dict[PoolKey, PooledTransport] = {}
+
+def pool_acquire(key: PoolKey) -> Optional[paramiko.SSHClient]:
+    """Return a live pooled client for this target, or None for a fresh connect."""
+    with POOL_LOCK:
+        ent = TRANSPORT_POOL.get(key)
+        if not ent:
+            return None
+        tr = ent.client.get_transport()
+        if not tr or not tr.is_active():
+            TRANSPORT_POOL.pop(key, None)
+            return None
+        if ent.refs >= MAX_CHANNELS_PER_TRANSPORT:
+            return None
+        ent.refs += 1
+        ent.last_used = now_ts()
+        return ent.client
+
+def pool_store(key: PoolKey, client: paramiko.SSHClient) -> bool:
+    """Pool a freshly connected client.
+
+    Returns False when a live entry already holds this key (two fresh
+    connects raced); overwriting it would orphan the pooled transport and
+    cross-wire later releases, so the caller keeps its client private.
+    """
+    with POOL_LOCK:
+        ent = TRANSPORT_POOL.get(key)
+        if ent:
+            tr = ent.client.get_transport()
+            if tr and tr.is_active():
+                return False
+        TRANSPORT_POOL[key] = PooledTransport(client=client, refs=1, last_used=now_ts())
+    _schedule_pool_evict()
+    return True
+
+def pool_release(key: PoolKey, client: Optional[paramiko.SSHClient] = None) -> None:
+    with POOL_LOCK:
+        ent = TRANSPORT_POOL.get(key)
+        # only drop a ref on the entry this session actually holds; the
+        # slot may have been re-filled after an eviction
+        if ent and (client is None or ent.client is client):
+            ent.refs = max(0, ent.refs - 1)
+            ent.last_used = now_ts()
+
+_POOL_TIMER: Optional[threading.Timer] = None
+
+def _schedule_pool_evict() -> None:
+    global _POOL_TIMER
+    if _POOL_TIMER is None or not _POOL_TIMER.is_alive():
+        _POOL_TIMER = threading.Timer(60.0, _pool_evict_tick)
+        _POOL_TIMER.daemon = True
+        _POOL_TIMER.start()
+
+def _pool_evict_tick() -> None:
+    global _POOL_TIMER
+    now = now_ts()
+    dead: List[paramiko.SSHClient] = []
+    with POOL_LOCK:
+        for key, ent in list(TRANSPORT_POOL.items()):
+            tr = ent.client.get_transport()
+            alive = tr is not None and tr.is_active()
+            if not alive or (ent.refs == 0 and now - ent.last_used > POOL_IDLE_TTL):
+                TRANSPORT_POOL.pop(key, None)
+                dead.append(ent.client)
+        empty = not TRANSPORT_POOL
+    for client in dead:
+        try:
+            client.close()
+        except Exception:
+            pass
+    if dead:
+        logger.info("Evicted %d idle SSH transport(s)", len(dead))
+    _POOL_TIMER = None
+    if not empty:
+        _schedule_pool_evict()
+
+# ================= IO REACTOR =================
+class IOReactor:
+    """Single thread multiplexing all SSH channels via selectors (epoll on Linux).
+
+    One reactor thread replaces one reader thread per session, so thread
+    count stays O(1) no matter how many sessions are open.
+    """
+
+    def __init__(self):
+        self._sel = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._fds: Dict[int, "SSHSession"] = {}
+
+    def register(self, sess: "SSHSession") -> None:
+        fd = sess.chan.fileno()
+        with self._lock:
+            sess._fd = fd
+            self._fds[fd] = sess
+            self._sel.register(fd, selectors.EVENT_READ, sess)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def unregister(self, sess: "SSHSession") -> None:
+        with self._lock:
+            fd = getattr(sess, "_fd", None)
+            if fd is None:
+                return
+            sess._fd = None
+            self._fds.pop(fd, None)
+            try:
+                self._sel.unregister(fd)
+            except Exception:
+                pass
+
+    def _run(self):
+        while True:
+            try:
+                events = self._sel.select(timeout=UPDATE_INTERVAL)
+            except Exception:
+                logger.exception("Reactor select failed")
+                time.sleep(UPDATE_INTERVAL)
+                continue
+
+            for skey, _ in events:
+                sess: "SSHSession" = skey.data
+                try:
+                    sess._on_readable()
+                except Exception:
+                    logger.exception("Reader error %s", sess.target)
+                    stop_session_async(sess.key)
+
+            with self._lock:
+                sessions = list(self._fds.values())
+            now = now_ts()
+            for sess in sessions:
+                if sess.stop.is_set():
+                    continue
+                if SESSION_TIMEOUT > 0 and (now - sess.last_activity) > SESSION_TIMEOUT:
+                    logger.info("Session timeout: %s", sess.target)
+                    stop_session_async(sess.key)
+                    continue
+                if now - sess.last_render_ts >= UPDATE_INTERVAL:
+                    try:
+                        sess.render_and_update()
+                    except Exception:
+                        logger.exception("Render error %s", sess.target)
+                    sess.last_render_ts = now
+
+REACTOR = IOReactor()
 
 # ================= SSH SESSION =================
+SEND_COALESCE_SEC = 0.02  # batch window for outbound channel writes
+_CLOSED_HTML = html_pre("Session closed")
+
 class SSHSession:
     def __init__(self, key: SessionKey, bot):
         self.key = key
@@ -402,49 +1027,98 @@ class SSHSession:
         self.client: Optional[paramiko.SSHClient] = None
         self.chan = None
         self.stop = threading.Event()
-        self.thread: Optional[threading.Thread] = None
+        self._fd: Optional[int] = None
+        self.pool_key: Optional[PoolKey] = None
+        self.pooled = False
+        # whether self.client is the one the pool tracks under pool_key;
+        # if not, closing it is this session's job
+        self._client_pooled = False
 
         self.screen = pyte.Screen(TERM_COLS, TERM_LINES)
-        self.stream = pyte.Stream(self.screen)
+        # ByteStream decodes incrementally itself, so multibyte sequences
+        # split across recv boundaries survive without an extra str hop
+        self.stream = pyte.ByteStream(self.screen)
 
         self.message_id: Optional[int] = None
         self.last_render = ""
         self.last_sent = ""
+        self.last_render_ts = 0.0
+        # Telegram can only show ~MAX_TG_CHARS anyway, so rendering is
+        # bounded to this many rows above the lowest row ever written.
+        self._tail_rows = min(TERM_LINES, MAX_TG_CHARS // (TERM_COLS + 1) + 2)
+        self._content_bottom = 0
+        self._escape_cache: Tuple[str, str] = ("", "")
+        self._line_cache: Dict[int, str] = {}
+        self._markup_timer: Optional[threading.Timer] = None
+        self._markup_sent_page: Optional[int] = None
+        self._send_lock = threading.Lock()
+        self._send_buf: List[str] = []
+        self._send_timer: Optional[threading.Timer] = None
 
         self.connected_at = now_ts()
         self.last_activity = now_ts()
         self.target = ""
+        self.target_html = ""
         self.kb_page = 0
 
     def start(self, user: str, host: str, port: int, password: str) -> Tuple[bool, Optional[str]]:
         try:
             self.target = f"{user}@{host}:{port}"
-            self.client = paramiko.SSHClient()
-
-            if STRICT_HOST_KEY:
-                self.client.load_system_host_keys()
-                self.client.set_missing_host_key_policy(paramiko.RejectPolicy())
+            self.target_html = self.target.translate(_HTML_ESC)
+            self.pool_key = (user, host, port, self.user_id)
+
+            # Reuse a pooled transport when one is already authenticated for
+            # this target; reconnects then only pay a channel open, not a full
+            # TCP + key exchange + auth round-trip.
+            pooled = pool_acquire(self.pool_key)
+            if pooled is not None:
+                self.client = pooled
+                self.pooled = True
+                self._client_pooled = True
             else:
-                self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-            self.client.connect(
-                host,
-                port=port,
-                username=user,
-                password=password,
-                look_for_keys=False,
-                allow_agent=False,
-                timeout=15,
-                banner_timeout=15,
-                auth_timeout=15,
-            )
+                self.client = paramiko.SSHClient()
+                self.pooled = False
+
+                if STRICT_HOST_KEY:
+                    self.client.load_system_host_keys()
+                    self.client.set_missing_host_key_policy(paramiko.RejectPolicy())
+                else:
+                    self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+                # hand paramiko a pre-connected socket; resolution comes from
+                # the DNS cache instead of a blocking lookup per connect
+                sock = open_tcp(host, port)
+                try:
+                    self.client.connect(
+                        host,
+                        port=port,
+                        username=user,
+                        password=password,
+                        look_for_keys=False,
+                        allow_agent=False,
+                        timeout=15,
+                        banner_timeout=15,
+                        auth_timeout=15,
+                        sock=sock,
+                        # terminal output is text; zlib pays for itself on
+                        # anything slower than a LAN
+                        compress=True,
+                    )
+                except Exception:
+                    try:
+                        sock.close()
+                    except OSError:
+                        pass
+                    raise
 
-            try:
-                tr = self.client.get_transport()
-                if tr:
-                    tr.set_keepalive(max(5, KEEPALIVE_SEC))
-            except Exception:
-                pass
+                try:
+                    tr = self.client.get_transport()
+                    if tr:
+                        tr.set_keepalive(max(5, KEEPALIVE_SEC))
+                except Exception:
+                    pass
+
+                self._client_pooled = pool_store(self.pool_key, self.client)
 
             self.chan = self.client.invoke_shell(width=TERM_COLS, height=TERM_LINES)
             self.chan.settimeout(0)
@@ -457,142 +1131,192 @@ class SSHSession:
                 disable_web_page_preview=True,
             )
             self.message_id = msg.message_id
+            self._markup_sent_page = self.kb_page
 
-            self.thread = threading.Thread(target=self.loop, daemon=True)
-            self.thread.start()
+            REACTOR.register(self)
             return True, None
 
         except Exception as e:
             logger.exception("SSH connect failed")
             return False, str(e)
 
-    def loop(self):
-        last_update = 0.0
-        while not self.stop.is_set():
-            try:
-                if SESSION_TIMEOUT > 0 and (now_ts() - self.last_activity) > SESSION_TIMEOUT:
-                    logger.info("Session timeout: %s", self.target)
-                    break
-
-                if self.chan and self.chan.recv_ready():
-                    data = self.chan.recv(4096)
-                    if not data:
-                        break
-                    self.last_activity = now_ts()
-                    self.stream.feed(data.decode(errors="replace"))
-
-                now = now_ts()
-                if now - last_update >= UPDATE_INTERVAL:
-                    self.render_and_update()
-                    last_update = now
-
-                time.sleep(0.05)
-            except Exception:
-                logger.exception("Reader loop error")
+    def _on_readable(self):
+        """Called from the reactor thread when the channel has data."""
+        if self.stop.is_set() or not self.chan:
+            return
+        # Drain everything queued in the kernel before feeding pyte once;
+        # bulk output then costs one state-machine pass instead of many.
+        chunks: List[bytes] = []
+        total = 0
+        while self.chan.recv_ready() and total < 262144:
+            data = self.chan.recv(65536)
+            if not data:
                 break
+            chunks.append(data)
+            total += len(data)
+        if not chunks:
+            # eof_received only covers a polite close; a dead transport
+            # (network drop, keepalive timeout) closes the channel without
+            # EOF and leaves the fd readable forever, which would spin the
+            # select loop on a channel that can never produce data.
+            tr = self.chan.get_transport()
+            if self.chan.eof_received or self.chan.closed or not (tr and tr.is_active()):
+                # runs on the reactor thread, so the blocking part of the
+                # teardown has to happen elsewhere
+                stop_session_async(self.key)
+            return
+        self.last_activity = now_ts()
+        self.stream.feed(b"".join(chunks))
 
-        try:
-            self.close()
-        except Exception:
-            pass
+    def _render_line(self, y: int) -> str:
+        row = self.screen.buffer[y]
+        return "".join(row[x].data for x in range(self.screen.columns)).rstrip()
 
     def render_and_update(self):
-        text = "\n".join(self.screen.display).rstrip()
+        # pyte tracks changed rows; an idle screen bails out here without
+        # materializing the full cols x lines display.
+        if not self.screen.dirty:
+            return
+
+        # Rows marked dirty by cursor movement alone render identically;
+        # track per-row text so those ticks never reach the network.
+        changed = False
+        for y in self.screen.dirty:
+            line = self._render_line(y)
+            if self._line_cache.get(y, "") != line:
+                self._line_cache[y] = line
+                changed = True
+        self.screen.dirty.clear()
+        if not changed:
+            return
+
+        # A wipe (clear / ^L) blanks every row and restarts output at the
+        # top, so the window bottom must follow the content back up rather
+        # than stick at its historical max; the cursor row counts so a bare
+        # prompt right after the wipe still shows.
+        bottom = self.screen.cursor.y
+        for y, line in self._line_cache.items():
+            if line and y > bottom:
+                bottom = y
+        self._content_bottom = bottom
+
+        top = max(0, self._content_bottom - self._tail_rows + 1)
+        text = "\n".join(
+            self._line_cache.get(y, "") for y in range(top, self._content_bottom + 1)
+        ).rstrip()
         if text == self.last_render:
             return
 
         self.last_render = text
         safe = clamp_tg(text)
 
-        if safe == self.last_sent:
+        # Telegram rejects empty message text; a just-wiped screen keeps its
+        # last frame until something is drawn
+        if not safe or safe == self.last_sent:
             return
 
-        try:
-            self.bot.edit_message_text(
-                chat_id=self.chat_id,
-                message_id=self.message_id,
-                text=html_pre(safe),
-                parse_mode=ParseMode.HTML,
-                reply_markup=self.keyboard(),
-                disable_web_page_preview=True,
-            )
-            self.last_sent = safe
-        except Exception as e:
-            logger.debug("Edit failed: %s", e)
+        EDIT_QUEUE.submit(
+            self.bot, self.chat_id, self.message_id,
+            f"<pre>{self._escape_html(safe)}</pre>", self.keyboard(),
+        )
+        self.last_sent = safe
+        self._markup_sent_page = self.kb_page
+
+    def _escape_html(self, text: str) -> str:
+        # Appended output (tail -f and friends) shares its prefix with the
+        # previous render; escape only the new suffix in that case.
+        raw, esc = self._escape_cache
+        if raw and text.startswith(raw):
+            esc = esc + text[len(raw):].translate(_HTML_ESC)
+        else:
+            esc = text.translate(_HTML_ESC)
+        self._escape_cache = (text, esc)
+        return esc
 
     def send(self, text: str):
+        """Buffer input briefly so a burst of messages becomes one channel write."""
+        if not self.chan or self.stop.is_set():
+            return
+        with self._send_lock:
+            self._send_buf.append(text)
+            if self._send_timer is None:
+                t = threading.Timer(SEND_COALESCE_SEC, self._flush_send)
+                t.daemon = True
+                self._send_timer = t
+                t.start()
+
+    def send_now(self, text: str):
+        """Write immediately (interactive keys); drains the buffer first to keep order."""
+        if not self.chan or self.stop.is_set():
+            return
+        with self._send_lock:
+            self._send_buf.append(text)
+        self._flush_send()
+
+    def _flush_send(self):
+        with self._send_lock:
+            t = self._send_timer
+            self._send_timer = None
+            if t is not None:
+                t.cancel()
+            buf, self._send_buf = self._send_buf, []
+        if not buf:
+            return
         try:
             if self.chan and not self.stop.is_set():
-                self.chan.send(text)
+                self.chan.send("".join(buf))
                 self.last_activity = now_ts()
         except Exception:
             logger.exception("Send failed")
 
+    def schedule_markup_refresh(self, delay: float = 0.25):
+        """Coalesce keyboard re-attaches during burst typing into one edit."""
+        t = self._markup_timer
+        if t is not None:
+            t.cancel()
+        t = threading.Timer(delay, self._do_markup_refresh)
+        t.daemon = True
+        self._markup_timer = t
+        t.start()
+
+    def _do_markup_refresh(self):
+        self._markup_timer = None
+        if self.stop.is_set() or not self.message_id:
+            return
+        # the attached markup only depends on the page; re-sending the same
+        # one draws a "message is not modified" error and wastes a call
+        if self._markup_sent_page == self.kb_page:
+            return
+        try:
+            self.bot.edit_message_reply_markup(
+                chat_id=self.chat_id, message_id=self.message_id, reply_markup=self.keyboard()
+            )
+            self._markup_sent_page = self.kb_page
+        except Exception as e:
+            logger.debug("Markup refresh failed: %s", e)
+
     def keyboard(self) -> InlineKeyboardMarkup:
-        if self.kb_page == 0:
-            rows = [
-                [
-                    InlineKeyboardButton("TAB", callback_data="K:TAB"),
-                    InlineKeyboardButton("ENTER", callback_data="K:ENTER"),
-                    InlineKeyboardButton("ESC", callback_data="K:ESC"),
-                    InlineKeyboardButton("BS", callback_data="K:BS"),
-                ],
-                [
-                    InlineKeyboardButton("↑", callback_data="K:UP"),
-                    InlineKeyboardButton("↓", callback_data="K:DOWN"),
-                    InlineKeyboardButton("←", callback_data="K:LEFT"),
-                    InlineKeyboardButton("→", callback_data="K:RIGHT"),
-                ],
-                [
-                    InlineKeyboardButton("PGUP", callback_data="K:PGUP"),
-                    InlineKeyboardButton("PGDN", callback_data="K:PGDN"),
-                    InlineKeyboardButton("Ctrl+C", callback_data="MC:CTRL_C"),
-                    InlineKeyboardButton("Ctrl+Z", callback_data="MC:CTRL_Z"),
-                ],
-                [
-                    InlineKeyboardButton("Nano Exit (Ctrl+X)", callback_data="K:NANO_EXIT"),
-                ],
-                [
-                    InlineKeyboardButton("⚡ سریع", callback_data="KB:PAGE:1"),
-                    InlineKeyboardButton("📚 سرورها", callback_data="A:SERVERS"),
-                    InlineKeyboardButton("🛑 قطع", callback_data="A:STOP"),
-                ],
-            ]
-            return InlineKeyboardMarkup(rows)
-
-        rows = [
-            [
-                InlineKeyboardButton("uptime", callback_data="QC:UPTIME"),
-                InlineKeyboardButton("df -h", callback_data="QC:DF"),
-                InlineKeyboardButton("free -h", callback_data="QC:FREE"),
-            ],
-            [
-                InlineKeyboardButton("whoami", callback_data="QC:WHOAMI"),
-                InlineKeyboardButton("pwd", callback_data="QC:PWD"),
-                InlineKeyboardButton("ls", callback_data="QC:LS"),
-            ],
-            [
-                InlineKeyboardButton("clear", callback_data="QC:CLEAR"),
-                InlineKeyboardButton("Ctrl+L", callback_data="MC:CTRL_L"),
-                InlineKeyboardButton("Ctrl+D", callback_data="MC:CTRL_D"),
-            ],
-            [
-                InlineKeyboardButton("🔙 بازگشت", callback_data="KB:PAGE:0"),
-                InlineKeyboardButton("📚 سرورها", callback_data="A:SERVERS"),
-                InlineKeyboardButton("🛑 قطع", callback_data="A:STOP"),
-            ],
-        ]
-        return InlineKeyboardMarkup(rows)
+        return _KB_SESSION_PAGE0 if self.kb_page == 0 else _KB_SESSION_PAGE1
 
     def close(self):
         self.stop.set()
+        REACTOR.unregister(self)
+        if self._markup_timer is not None:
+            self._markup_timer.cancel()
+        if self._send_timer is not None:
+            self._send_timer.cancel()
         try:
             if self.chan:
                 try:
                     self.chan.close()
                 except Exception:
                     pass
-            if self.client:
+            # A pooled transport stays open for fast reconnects; the evictor
+            # closes it once it has been idle long enough. A client the pool
+            # never tracked (failed start, lost connect race) is ours to close.
+            if self._client_pooled and self.pool_key:
+                pool_release(self.pool_key, self.client)
+            elif self.client:
                 try:
                     self.client.close()
                 except Exception:
@@ -602,10 +1326,13 @@ class SSHSession:
 
         try:
             if self.message_id:
+                # drop any queued terminal frame so it cannot overwrite the
+                # closed notice after this edit
+                EDIT_QUEUE.discard(self.chat_id, self.message_id)
                 self.bot.edit_message_text(
                     chat_id=self.chat_id,
                     message_id=self.message_id,
-                    text=html_pre("Session closed"),
+                    text=_CLOSED_HTML,
                     parse_mode=ParseMode.HTML,
                     reply_markup=None,
                     disable_web_page_preview=True,
@@ -616,12 +1343,14 @@ class SSHSession:
         logger.info("Session closed %s", self.target or str(self.key))
 
 # ================= SESSION HELPERS =================
+# Single-key dict get/set/pop is atomic under the GIL in CPython; the
+# striped locks are only needed for compound read-modify-write sequences,
+# so plain reads skip them entirely.
 def get_session(key: SessionKey) -> Optional[SSHSession]:
-    with STATE_LOCK:
-        return SESSIONS.get(key)
+    return SESSIONS.get(key)
 
 def stop_session(key: SessionKey) -> bool:
-    with STATE_LOCK:
+    with state_lock(key):
         s = SESSIONS.pop(key, None)
     if s:
         try:
@@ -631,33 +1360,69 @@ def stop_session(key: SessionKey) -> bool:
         return True
     return False
 
+def stop_session_async(key: SessionKey) -> None:
+    """Teardown safe to call from the reactor thread.
+
+    close() blocks on a Telegram edit (up to the configured read timeout),
+    which would stall reads and renders for every other session; detach the
+    fd and flag the stop synchronously, then finish on the IO pool.
+    """
+    s = get_session(key)
+    if s:
+        s.stop.set()
+        REACTOR.unregister(s)
+    IO_POOL.submit(stop_session, key)
+
 def clear_wizard(key: SessionKey) -> None:
-    with STATE_LOCK:
+    with state_lock(key):
         WIZARD.pop(key, None)
         PENDING.pop(key, None)
 
 def set_wizard(key: SessionKey, st: WizardState) -> None:
-    with STATE_LOCK:
+    with state_lock(key):
         WIZARD[key] = st
 
 def get_wizard(key: SessionKey) -> Optional[WizardState]:
-    with STATE_LOCK:
-        return WIZARD.get(key)
+    return WIZARD.get(key)
 
 def set_pending(key: SessionKey, p: PendingConn) -> None:
-    with STATE_LOCK:
+    with state_lock(key):
         PENDING[key] = p
 
 def get_pending(key: SessionKey) -> Optional[PendingConn]:
-    with STATE_LOCK:
-        return PENDING.get(key)
+    return PENDING.get(key)
+
+def _reaper_tick() -> None:
+    """Evict abandoned wizard/pending entries so they cannot pile up forever."""
+    cutoff = now_ts() - WIZARD_TTL
+    reaped = 0
+    for store in (WIZARD, PENDING):
+        for key in list(store.keys()):
+            with state_lock(key):
+                st = store.get(key)
+                if st is not None and st.created_at < cutoff:
+                    store.pop(key, None)
+                    reaped += 1
+    if reaped:
+        logger.info("Reaped %d stale wizard/pending entries", reaped)
+    t = threading.Timer(60.0, _reaper_tick)
+    t.daemon = True
+    t.start()
 
 # ================= MODIFIER HELPERS =================
+# CTRL+<char> is just the low 5 bits of the ASCII code; precompute the
+# whole table so the hot path is one subscript.
+_CTRL_TABLE = bytes(b & 0x1F for b in range(128))
+
+# frozensets give hashed membership tests instead of tuple scans
+_CTRL_SET = frozenset(("ctrl", "control"))
+_ALT_SET = frozenset(("alt", "meta"))
+_SHIFT_SET = frozenset(("shift",))
+
 def parse_combo_tokens(tokens: List[str]) -> Tuple[List[str], str]:
     merged: List[str] = []
     for t in tokens:
-        parts = re.split(r"[+]", t)
-        for p in parts:
+        for p in t.split("+"):
             p = p.strip()
             if p:
                 merged.append(p.lower())
@@ -665,13 +1430,13 @@ def parse_combo_tokens(tokens: List[str]) -> Tuple[List[str], str]:
     mods = []
     key = ""
     for tok in merged:
-        if tok in ("ctrl", "control"):
+        if tok in _CTRL_SET:
             if "CTRL" not in mods:
                 mods.append("CTRL")
-        elif tok in ("alt", "meta"):
+        elif tok in _ALT_SET:
             if "ALT" not in mods:
                 mods.append("ALT")
-        elif tok in ("shift",):
+        elif tok in _SHIFT_SET:
             if "SHIFT" not in mods:
                 mods.append("SHIFT")
         else:
@@ -695,16 +1460,8 @@ def build_sequence_from_mods_and_key(mods: List[str], key_token: str) -> str:
         seq += "\x1b"
 
     if "CTRL" in mods:
-        c = ch0.lower()
-        if "a" <= c <= "z":
-            seq += chr(ord(c) - 96)
-            return seq
-        try:
-            seq += chr(ord(ch0) & 0x1f)
-            return seq
-        except Exception:
-            seq += ch0
-            return seq
+        seq += chr(_CTRL_TABLE[ord(ch0) & 0x7F])
+        return seq
     else:
         if "SHIFT" in mods:
             seq += ch0.upper()
@@ -809,20 +1566,21 @@ def wizard_process_text(update: Update, ctx: CallbackContext) -> bool:
         stop_session(key)
 
         sess = SSHSession(key, ctx.bot)
-        with STATE_LOCK:
+        with state_lock(key):
             SESSIONS[key] = sess
 
         ok, err = sess.start(p.user, p.host, p.port, pwd)
         clear_wizard(key)
 
         if not ok:
-            with STATE_LOCK:
-                SESSIONS.pop(key, None)
+            # close() releases the pool ref (or the un-pooled client) that a
+            # partially started session may be holding
+            stop_session(key)
             ctx.bot.send_message(chat_id, f"❌ اتصال ناموفق:\n<code>{html.escape(str(err))}</code>", parse_mode=ParseMode.HTML)
         else:
             ctx.bot.send_message(
                 chat_id,
-                f"✅ وصل شدی به <b>{html.escape(sess.target)}</b>",
+                f"✅ وصل شدی به <b>{sess.target_html}</b>",
                 parse_mode=ParseMode.HTML,
                 reply_markup=keyboard_main(user_id),
             )
@@ -878,6 +1636,7 @@ def wizard_process_text(update: Update, ctx: CallbackContext) -> bool:
             "last_used": int(now_ts()),
         }
         set_user_servers(user_id, servers)
+        warm_dns(host, port)
 
         clear_wizard(key)
         ctx.bot.send_message(chat_id, f"✅ سرور <b>{html.escape(name)}</b> ذخیره شد.", parse_mode=ParseMode.HTML,
@@ -911,25 +1670,26 @@ def id_cmd(update: Update, ctx: CallbackContext):
     user_id = update.effective_user.id
     update.message.reply_text(f"🆔 User ID: {user_id}\n🧾 Chat ID: {chat_id}")
 
+HELP_TEXT = (
+    "HELP / راهنما\n\n"
+    "✅ حالت دکمه‌ای: /start یا /menu\n"
+    "🆔 گرفتن آی‌دی: /id\n\n"
+    "Legacy commands:\n"
+    " /ssh user@host[:port]\n"
+    " /pass <password>  (پیام حذف میشه)\n"
+    " /stop\n\n"
+    "Multi-server:\n"
+    " /servers\n"
+    " /addserver <name> user@host[:port]\n"
+    " /delserver <name>\n\n"
+    "Key combos:\n"
+    " /ctrl c   /alt a   /keys ctrl+alt+c\n"
+)
+
 def help_cmd(update: Update, ctx: CallbackContext):
     if not guard(update):
         return
-    text = (
-        "HELP / راهنما\n\n"
-        "✅ حالت دکمه‌ای: /start یا /menu\n"
-        "🆔 گرفتن آی‌دی: /id\n\n"
-        "Legacy commands:\n"
-        " /ssh user@host[:port]\n"
-        " /pass <password>  (پیام حذف میشه)\n"
-        " /stop\n\n"
-        "Multi-server:\n"
-        " /servers\n"
-        " /addserver <name> user@host[:port]\n"
-        " /delserver <name>\n\n"
-        "Key combos:\n"
-        " /ctrl c   /alt a   /keys ctrl+alt+c\n"
-    )
-    update.message.reply_text(text)
+    update.message.reply_text(HELP_TEXT)
 
 def servers_cmd(update: Update, ctx: CallbackContext):
     if not guard(update):
@@ -968,6 +1728,7 @@ def addserver_cmd(update: Update, ctx: CallbackContext):
 
     servers[sid] = {"name": name, "user": user, "host": host, "port": port, "created_at": int(now_ts()), "last_used": int(now_ts())}
     set_user_servers(user_id, servers)
+    warm_dns(host, port)
 
     update.message.reply_text("✅ ذخیره شد.", reply_markup=keyboard_servers_list(user_id))
 
@@ -1042,25 +1803,34 @@ def pass_cmd(update: Update, ctx: CallbackContext):
         update.message.reply_text("Usage: /pass <password>")
         return
 
-    pwd = " ".join(ctx.args)
+    # take the raw text after the command so passwords keep their exact
+    # whitespace; ctx.args would collapse runs of spaces. The separator can
+    # be any whitespace (tab/newline count), so scan rather than partition.
+    raw = update.message.text or ""
+    pwd = ""
+    for i, ch in enumerate(raw):
+        if ch in " \t\n":
+            pwd = raw[i + 1:]
+            break
+    if not pwd:
+        update.message.reply_text("Usage: /pass <password>")
+        return
 
-    try:
-        update.message.delete()
-    except Exception:
-        pass
+    # the message holds a plaintext password; no debounce here
+    queue_delete(ctx.bot, chat_id, update.message.message_id, flush=True)
 
     stop_session(key)
     sess = SSHSession(key, ctx.bot)
-    with STATE_LOCK:
+    with state_lock(key):
         SESSIONS[key] = sess
 
     ok, err = sess.start(p.user, p.host, p.port, pwd)
-    with STATE_LOCK:
-        PENDING.pop(key, None)
+    PENDING.pop(key, None)
 
     if not ok:
-        with STATE_LOCK:
-            SESSIONS.pop(key, None)
+        # close() releases the pool ref (or the un-pooled client) that a
+        # partially started session may be holding
+        stop_session(key)
         update.message.reply_text(f"❌ اتصال ناموفق: {err}")
     else:
         update.message.reply_text("✅ وصل شدی.")
@@ -1084,228 +1854,244 @@ def text_msg(update: Update, ctx: CallbackContext):
     if not s:
         return
 
-    try:
-        ctx.bot.delete_message(update.effective_chat.id, update.message.message_id)
-    except Exception:
-        pass
+    queue_delete(ctx.bot, update.effective_chat.id, update.message.message_id)
 
     s.send((update.message.text or "") + "\n")
 
-def cb(update: Update, ctx: CallbackContext):
-    q = update.callback_query
-    if not q:
-        return
+# --- callback handlers: exact-match entries take (update, ctx, q, key),
+# --- prefixed entries additionally get the payload after the prefix.
+def _cb_wizard_cancel(update, ctx, q, key: SessionKey):
+    chat_id, user_id = key
+    clear_wizard(key)
+    q.answer("لغو شد")
+    submit_ordered(chat_id, ctx.bot.send_message, chat_id, "❌ لغو شد.", reply_markup=keyboard_main(user_id))
 
-    # auth checks
-    if PRIVATE_ONLY:
-        try:
-            if q.message.chat.type != "private":
-                q.answer("⛔ فقط خصوصی", show_alert=True)
-                return
-        except Exception:
-            pass
-    if ALLOWED_USERS and q.from_user.id not in ALLOWED_USERS:
-        q.answer("⛔ دسترسی نداری", show_alert=True)
-        return
-    if ALLOWED_CHATS and q.message.chat_id not in ALLOWED_CHATS:
-        q.answer("⛔ دسترسی نداری", show_alert=True)
-        return
+def _cb_menu(update, ctx, q, key: SessionKey):
+    chat_id, user_id = key
+    submit_ordered(chat_id, q.edit_message_text, "منو:", reply_markup=keyboard_main(user_id))
+    q.answer()
 
-    key = session_key_from_query(update)
+def _cb_help(update, ctx, q, key: SessionKey):
     chat_id, user_id = key
-    data = q.data or ""
+    q.answer()
+    submit_ordered(chat_id, ctx.bot.send_message, chat_id, "راهنما: /help")
 
-    # wizard cancel
-    if data == "W:CANCEL":
-        clear_wizard(key)
-        q.answer("لغو شد")
-        ctx.bot.send_message(chat_id, "❌ لغو شد.", reply_markup=keyboard_main(user_id))
-        return
+def _cb_myid(update, ctx, q, key: SessionKey):
+    chat_id, user_id = key
+    q.answer()
+    submit_ordered(chat_id, ctx.bot.send_message, chat_id, f"🆔 User ID: {user_id}\n🧾 Chat ID: {chat_id}")
 
-    # menu
-    if data == "M:MENU":
-        q.edit_message_text("منو:", reply_markup=keyboard_main(user_id))
-        q.answer()
+def _cb_status(update, ctx, q, key: SessionKey):
+    chat_id, user_id = key
+    s = get_session(key)
+    if not s:
+        q.answer("سشن فعال نیست")
         return
+    uptime = int(now_ts() - s.connected_at)
+    idle = int(now_ts() - s.last_activity)
+    q.answer("OK")
+    submit_ordered(chat_id, ctx.bot.send_message, chat_id, f"📊 وضعیت:\nTarget: {s.target}\nUptime: {uptime}s\nIdle: {idle}s")
 
-    if data == "M:HELP":
-        q.answer()
-        ctx.bot.send_message(chat_id, "راهنما: /help")
-        return
+def _cb_stop(update, ctx, q, key: SessionKey):
+    stopped = stop_session(key)
+    clear_wizard(key)
+    q.answer("قطع شد" if stopped else "سشن فعالی نیست")
 
-    if data == "M:MYID":
-        q.answer()
-        ctx.bot.send_message(chat_id, f"🆔 User ID: {user_id}\n🧾 Chat ID: {chat_id}")
-        return
+def _cb_connect(update, ctx, q, key: SessionKey):
+    q.answer()
+    wizard_ask_target(update, ctx)
 
-    if data == "M:STATUS":
-        s = get_session(key)
-        if not s:
-            q.answer("سشن فعال نیست")
-            return
-        uptime = int(now_ts() - s.connected_at)
-        idle = int(now_ts() - s.last_activity)
-        q.answer("OK")
-        ctx.bot.send_message(chat_id, f"📊 وضعیت:\nTarget: {s.target}\nUptime: {uptime}s\nIdle: {idle}s")
-        return
+def _cb_add_server(update, ctx, q, key: SessionKey):
+    q.answer()
+    wizard_start_add_server(update, ctx)
 
-    if data == "M:STOP":
-        stopped = stop_session(key)
-        clear_wizard(key)
-        q.answer("قطع شد" if stopped else "سشن فعالی نیست")
-        return
+def _cb_servers(update, ctx, q, key: SessionKey):
+    chat_id, user_id = key
+    submit_ordered(chat_id, _edit_or_send, ctx.bot, q, chat_id, "📚 سرورهای شما:", keyboard_servers_list(user_id))
+    q.answer()
 
-    if data == "M:CONNECT":
-        q.answer()
-        wizard_ask_target(update, ctx)
-        return
+def _cb_a_stop(update, ctx, q, key: SessionKey):
+    stopped = stop_session(key)
+    q.answer("قطع شد" if stopped else "سشن فعال نیست")
 
-    if data == "M:ADD_SERVER":
-        q.answer()
-        wizard_start_add_server(update, ctx)
-        return
+def _cb_a_servers(update, ctx, q, key: SessionKey):
+    chat_id, user_id = key
+    q.answer()
+    submit_ordered(chat_id, ctx.bot.send_message, chat_id, "📚 سرورها:", reply_markup=keyboard_servers_list(user_id))
 
-    if data == "M:SERVERS":
-        try:
-            q.edit_message_text("📚 سرورهای شما:", reply_markup=keyboard_servers_list(user_id))
-        except Exception:
-            ctx.bot.send_message(chat_id, "📚 سرورهای شما:", reply_markup=keyboard_servers_list(user_id))
-        q.answer()
+def _cb_sv_open(sid: str, update, ctx, q, key: SessionKey):
+    chat_id, user_id = key
+    servers = get_user_servers(user_id)
+    info = servers.get(sid)
+    if not isinstance(info, dict):
+        q.answer("پیدا نشد", show_alert=True)
         return
+    name = str(info.get("name", sid))
+    user = str(info.get("user", ""))
+    host = str(info.get("host", ""))
+    port = int(info.get("port", 22))
+    default_id = get_user_default_server_id(user_id)
+    star = "⭐ " if sid == default_id else ""
+    text = (
+        f"{star}<b>{name.translate(_HTML_ESC)}</b>\n"
+        f"<code>{user.translate(_HTML_ESC)}@{host.translate(_HTML_ESC)}:{port}</code>"
+    )
+    submit_ordered(chat_id, q.edit_message_text, text, parse_mode=ParseMode.HTML, reply_markup=keyboard_server_actions(sid))
+    q.answer()
 
-    # server actions
-    if data.startswith("SV:OPEN:"):
-        sid = data.split("SV:OPEN:", 1)[1]
-        servers = get_user_servers(user_id)
-        info = servers.get(sid)
-        if not isinstance(info, dict):
-            q.answer("پیدا نشد", show_alert=True)
-            return
-        name = str(info.get("name", sid))
-        user = str(info.get("user", ""))
-        host = str(info.get("host", ""))
-        port = int(info.get("port", 22))
-        default_id = get_user_default_server_id(user_id)
-        star = "⭐ " if sid == default_id else ""
-        text = f"{star}<b>{html.escape(name)}</b>\n<code>{html.escape(user)}@{html.escape(host)}:{port}</code>"
-        q.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=keyboard_server_actions(sid))
-        q.answer()
+def _cb_sv_connect(sid: str, update, ctx, q, key: SessionKey):
+    chat_id, user_id = key
+    servers = get_user_servers(user_id)
+    info = servers.get(sid)
+    if not isinstance(info, dict):
+        q.answer("پیدا نشد", show_alert=True)
         return
-
-    if data.startswith("SV:CONNECT:"):
-        sid = data.split("SV:CONNECT:", 1)[1]
-        servers = get_user_servers(user_id)
-        info = servers.get(sid)
-        if not isinstance(info, dict):
-            q.answer("پیدا نشد", show_alert=True)
-            return
-        info["last_used"] = int(now_ts())
-        servers[sid] = info
+    touch_server_last_used(user_id, sid)
+
+    set_pending(key, PendingConn(
+        user=str(info.get("user", "")),
+        host=str(info.get("host", "")),
+        port=int(info.get("port", 22)),
+        server_id=sid
+    ))
+    q.answer("پسورد رو بفرست…")
+    wizard_ask_password(ctx, key)
+
+def _cb_sv_delete(sid: str, update, ctx, q, key: SessionKey):
+    chat_id, user_id = key
+    servers = get_user_servers(user_id)
+    if sid not in servers:
+        q.answer("پیدا نشد", show_alert=True)
+        return
+    servers.pop(sid, None)
+    default_id = get_user_default_server_id(user_id)
+    if default_id == sid:
+        set_user_servers(user_id, servers, default_id="")
+    else:
         set_user_servers(user_id, servers)
+    q.answer("حذف شد")
+    submit_ordered(chat_id, q.edit_message_text, "📚 سرورهای شما:", reply_markup=keyboard_servers_list(user_id))
 
-        set_pending(key, PendingConn(
-            user=str(info.get("user", "")),
-            host=str(info.get("host", "")),
-            port=int(info.get("port", 22)),
-            server_id=sid
-        ))
-        q.answer("پسورد رو بفرست…")
-        wizard_ask_password(ctx, key)
+def _cb_sv_default(sid: str, update, ctx, q, key: SessionKey):
+    chat_id, user_id = key
+    servers = get_user_servers(user_id)
+    if sid not in servers:
+        q.answer("پیدا نشد", show_alert=True)
         return
+    set_user_default_server_id(user_id, sid)
+    q.answer("پیش‌فرض شد ⭐")
+    submit_ordered(chat_id, q.edit_message_text, "📚 سرورهای شما:", reply_markup=keyboard_servers_list(user_id))
 
-    if data.startswith("SV:DELETE:"):
-        sid = data.split("SV:DELETE:", 1)[1]
-        servers = get_user_servers(user_id)
-        if sid not in servers:
-            q.answer("پیدا نشد", show_alert=True)
-            return
-        servers.pop(sid, None)
-        default_id = get_user_default_server_id(user_id)
-        if default_id == sid:
-            set_user_servers(user_id, servers, default_id="")
-        else:
-            set_user_servers(user_id, servers)
-        q.answer("حذف شد")
-        try:
-            q.edit_message_text("📚 سرورهای شما:", reply_markup=keyboard_servers_list(user_id))
-        except Exception:
-            pass
+def _cb_kb_page(payload: str, update, ctx, q, key: SessionKey):
+    chat_id, user_id = key
+    s = get_session(key)
+    if not s:
+        q.answer("سشن فعال نیست")
         return
+    try:
+        page = int(payload)
+    except Exception:
+        page = 0
+    s.kb_page = page
+    s._markup_sent_page = page
+    submit_ordered(chat_id, ctx.bot.edit_message_reply_markup, chat_id=chat_id, message_id=q.message.message_id, reply_markup=s.keyboard())
+    q.answer()
 
-    if data.startswith("SV:DEFAULT:"):
-        sid = data.split("SV:DEFAULT:", 1)[1]
-        servers = get_user_servers(user_id)
-        if sid not in servers:
-            q.answer("پیدا نشد", show_alert=True)
-            return
-        set_user_default_server_id(user_id, sid)
-        q.answer("پیش‌فرض شد ⭐")
-        try:
-            q.edit_message_text("📚 سرورهای شما:", reply_markup=keyboard_servers_list(user_id))
-        except Exception:
-            pass
+def _cb_key(keyname: str, update, ctx, q, key: SessionKey):
+    s = get_session(key)
+    if not s:
+        q.answer("سشن فعال نیست")
         return
+    val = KEYS.get(keyname)
+    if val is not None:
+        s.send_now(val)
+    q.answer()
 
-    # terminal UI
+def _cb_macro(mname: str, update, ctx, q, key: SessionKey):
     s = get_session(key)
+    if not s:
+        q.answer("سشن فعال نیست")
+        return
+    seq = MACROS.get(mname, "")
+    if seq:
+        s.send_now(seq)
+    q.answer()
 
-    if data.startswith("KB:PAGE:"):
-        if not s:
-            q.answer("سشن فعال نیست")
-            return
-        try:
-            page = int(data.split(":", 2)[2])
-        except Exception:
-            page = 0
-        s.kb_page = page
+def _cb_quick(cname: str, update, ctx, q, key: SessionKey):
+    s = get_session(key)
+    if not s:
+        q.answer("سشن فعال نیست")
+        return
+    cmd = QUICK_CMDS.get(cname, "")
+    if cmd:
+        s.send_now(cmd)
+    q.answer()
+
+_CB_EXACT = {
+    "W:CANCEL": _cb_wizard_cancel,
+    "M:MENU": _cb_menu,
+    "M:HELP": _cb_help,
+    "M:MYID": _cb_myid,
+    "M:STATUS": _cb_status,
+    "M:STOP": _cb_stop,
+    "M:CONNECT": _cb_connect,
+    "M:ADD_SERVER": _cb_add_server,
+    "M:SERVERS": _cb_servers,
+    "A:STOP": _cb_a_stop,
+    "A:SERVERS": _cb_a_servers,
+}
+
+_CB_SINGLE_PREFIXES = frozenset(("K", "MC", "QC"))
+
+_CB_PREFIX = {
+    "K": _cb_key,
+    "MC": _cb_macro,
+    "QC": _cb_quick,
+    "SV:OPEN": _cb_sv_open,
+    "SV:CONNECT": _cb_sv_connect,
+    "SV:DELETE": _cb_sv_delete,
+    "SV:DEFAULT": _cb_sv_default,
+    "KB:PAGE": _cb_kb_page,
+}
+
+def cb(update: Update, ctx: CallbackContext):
+    q = update.callback_query
+    if not q:
+        return
+
+    # auth checks
+    if PRIVATE_ONLY:
         try:
-            ctx.bot.edit_message_reply_markup(chat_id=chat_id, message_id=q.message.message_id, reply_markup=s.keyboard())
+            if q.message.chat.type != "private":
+                q.answer("⛔ فقط خصوصی", show_alert=True)
+                return
         except Exception:
             pass
-        q.answer()
+    if ALLOWED_USERS and q.from_user.id not in ALLOWED_USERS:
+        q.answer("⛔ دسترسی نداری", show_alert=True)
         return
-
-    if data == "A:STOP":
-        stopped = stop_session(key)
-        q.answer("قطع شد" if stopped else "سشن فعال نیست")
+    if ALLOWED_CHATS and q.message.chat_id not in ALLOWED_CHATS:
+        q.answer("⛔ دسترسی نداری", show_alert=True)
         return
 
-    if data == "A:SERVERS":
-        q.answer()
-        ctx.bot.send_message(chat_id, "📚 سرورها:", reply_markup=keyboard_servers_list(user_id))
-        return
+    key = session_key_from_query(update)
+    data = q.data or ""
 
-    if data.startswith("K:"):
-        if not s:
-            q.answer("سشن فعال نیست")
-            return
-        keyname = data[2:]
-        val = KEYS.get(keyname)
-        if val is not None:
-            s.send(val)
-        q.answer()
+    handler = _CB_EXACT.get(data)
+    if handler:
+        handler(update, ctx, q, key)
         return
 
-    if data.startswith("MC:"):
-        if not s:
-            q.answer("سشن فعال نیست")
-            return
-        mname = data.split("MC:", 1)[1]
-        seq = MACROS.get(mname, "")
-        if seq:
-            s.send(seq)
-        q.answer()
-        return
+    parts = data.split(":", 2)
+    if parts[0] in _CB_SINGLE_PREFIXES:
+        handler = _CB_PREFIX.get(parts[0])
+        payload = data[len(parts[0]) + 1:]
+    else:
+        handler = _CB_PREFIX.get(":".join(parts[:2]))
+        payload = parts[2] if len(parts) == 3 else ""
 
-    if data.startswith("QC:"):
-        if not s:
-            q.answer("سشن فعال نیست")
-            return
-        cname = data.split("QC:", 1)[1]
-        cmd = QUICK_CMDS.get(cname, "")
-        if cmd:
-            s.send(cmd)
-        q.answer()
+    if handler:
+        handler(payload, update, ctx, q, key)
         return
 
     q.answer()
@@ -1316,10 +2102,7 @@ def process_modifier_command(primary_mod: str, update: Update, ctx: CallbackCont
     chat_id, user_id = key
     s = get_session(key)
 
-    try:
-        update.message.delete()
-    except Exception:
-        pass
+    queue_delete(ctx.bot, chat_id, update.message.message_id)
 
     if not s:
         update.message.reply_text("No active session. / سشن فعالی وجود ندارد.")
@@ -1333,12 +2116,8 @@ def process_modifier_command(primary_mod: str, update: Update, ctx: CallbackCont
         update.message.reply_text("Could not parse key. Usage: /ctrl c  or /keys ctrl+alt+c")
         return
 
-    s.send(seq)
-    try:
-        if s.message_id:
-            ctx.bot.edit_message_reply_markup(chat_id=chat_id, message_id=s.message_id, reply_markup=s.keyboard())
-    except Exception:
-        pass
+    s.send_now(seq)
+    s.schedule_markup_refresh()
 
 def ctrl_cmd(update: Update, ctx: CallbackContext):
     if not guard(update):
@@ -1362,10 +2141,7 @@ def keys_cmd(update: Update, ctx: CallbackContext):
     chat_id, user_id = key
     s = get_session(key)
 
-    try:
-        update.message.delete()
-    except Exception:
-        pass
+    queue_delete(ctx.bot, chat_id, update.message.message_id)
 
     if not s:
         update.message.reply_text("No active session. / سشن فعالی وجود ندارد.")
@@ -1382,7 +2158,7 @@ def keys_cmd(update: Update, ctx: CallbackContext):
         update.message.reply_text("Could not parse key.")
         return
 
-    s.send(seq)
+    s.send_now(seq)
 
 # ================= MAIN =================
 def main():
@@ -1390,7 +2166,18 @@ def main():
         print("BOT_TOKEN missing")
         return
 
-    up = Updater(BOT_TOKEN, use_context=True)
+    # pool sized for the dispatcher workers plus our own IO_POOL threads so
+    # concurrent API calls reuse connections instead of queueing on urllib3
+    up = Updater(
+        BOT_TOKEN,
+        use_context=True,
+        workers=16,
+        request_kwargs={
+            "con_pool_size": 64,
+            "read_timeout": 20,
+            "connect_timeout": 10,
+        },
+    )
     dp = up.dispatcher
 
     dp.add_handler(CommandHandler("start", start_cmd))
@@ -1415,8 +2202,20 @@ def main():
     dp.add_handler(MessageHandler(Filters.text & ~Filters.command, text_msg))
     dp.add_handler(CallbackQueryHandler(cb))
 
-    logger.info("SSH bot started")
-    up.start_polling()
+    _reaper_tick()
+
+    if WEBHOOK_URL:
+        # Push delivery: no idle polls, input latency drops to network RTT.
+        logger.info("SSH bot started (webhook on port %d)", WEBHOOK_PORT)
+        up.start_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_SECRET,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_SECRET}",
+        )
+    else:
+        logger.info("SSH bot started (polling)")
+        up.start_polling()
     up.idle()
 
 if __name__ == "__main__":